@@ -1,10 +1,11 @@
-from dotenv import dotenv_values
+from dotenv import load_dotenv
+import os
 import time
 from anthropic import Anthropic, RateLimitError
 
 CLAUDE_MODEL = "claude-3-haiku-20240307"
 MAX_TOKENS = 4096
-CONFIG = dotenv_values(".env")
+load_dotenv()
 
 
 SYSTEM_PROMPT = """
@@ -38,7 +39,7 @@ Make sure to enter your response in <response> tags
 
 
 client = Anthropic(
-    api_key=CONFIG["claude_key"],
+    api_key=os.getenv("claude_key", os.getenv("ANTHROPIC_API_KEY")),
 )
 
 
@@ -1,11 +1,19 @@
-from dotenv import dotenv_values
+from dotenv import load_dotenv
+import json
+import os
+import random
 import time
 import textwrap
 from anthropic import Anthropic, RateLimitError
 
 CLAUDE_MODEL = "claude-3-haiku-20240307"
 MAX_TOKENS = 4096
-CONFIG = dotenv_values(".env")
+MAX_ATTEMPTS = 8
+MAX_BACKOFF = 30
+MAX_CONTEXT_TOKENS = 8000
+load_dotenv()
+# The tools beta endpoint sets its own anthropic-beta header, so both betas are passed per request
+BETA_HEADERS = {"anthropic-beta": "tools-2024-04-04,prompt-caching-2024-07-31"}
 
 SYSTEM_PROMPT = """
 You are a diligent and fastidious research assistant, helping people to understand the world around them.
@@ -14,8 +22,40 @@ Before you answer, think through the facts available in <scratchpad> tags. Inclu
 Return your final answer to the user in a <response> tag. Be sure to note any discrepancies you may have found so that the user won't be confused.
 """
 
+TOOLS = [
+    {
+        "name": "get_weather",
+        "description": "Get the current weather in a given location",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "location": {
+                    "type": "string",
+                    "description": "The city and state, e.g. San Francisco, CA",
+                }
+            },
+            "required": ["location"],
+        },
+    },
+    {
+        "name": "get_facts",
+        "description": "Use this tool to get facts about any topic. Assume that this tool is returning definitive answers from a reliable source. You can only look up one topic at a time. For example, if someone asks 'How many people live in Providence, RI?' You would input 'Providence, RI' as the topic.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "topic": {
+                    "type": "string",
+                    "description": "The topic for retrieving facts",
+                }
+            },
+            "required": ["topic"],
+        },
+        "cache_control": {"type": "ephemeral"},
+    },
+]
+
 client = Anthropic(
-    api_key=CONFIG["claude_key"],
+    api_key=os.getenv("claude_key", os.getenv("ANTHROPIC_API_KEY")),
 )
 
 
@@ -28,7 +68,7 @@ def handle_tool_use(tool_name, input):
         input (dict): The input data for the tool.
 
     Returns:
-        str: The result of the tool use.
+        str: The result of the tool use, or an error message for Claude if a required field is missing from the input.
 
     Raises:
         None
@@ -36,13 +76,16 @@ def handle_tool_use(tool_name, input):
     """
     print(f"---> TOOL USE {tool_name}, INPUT {input}")
 
-    match tool_name:
-        case "get_weather":
-            return get_weather(input["location"])
-        case "get_facts":
-            return get_facts(input["topic"])
-        case _:
-            return "n/a"
+    try:
+        match tool_name:
+            case "get_weather":
+                return get_weather(input["location"])
+            case "get_facts":
+                return get_facts(input["topic"])
+            case _:
+                return "n/a"
+    except KeyError as e:
+        return f"Error: missing field {e}"
 
 
 def get_weather(input):
@@ -73,6 +116,19 @@ def get_facts(input):
     return f"Here are some facts about {input}:\n- It is the most sought-after attraction in all of Northsborough, New Hampshire\n- 90% of participants love it!\n- It's purple\n- It is located in Northsborough, which is a small unincorporated area in New Hampshire that may not show up on your maps. It is NOT located in Northborough, MA. Ask locals for directions!"
 
 
+def backoff(attempt):
+    """
+    Calculates an exponential backoff time with jitter for a given retry attempt.
+
+    Args:
+        attempt (int): The number of the failed attempt, starting from 0.
+
+    Returns:
+        float: The number of seconds to sleep before retrying, capped at MAX_BACKOFF (plus jitter).
+    """
+    return min(MAX_BACKOFF, 2**attempt) * (1 + random.random() * 0.5)
+
+
 def ask_claude_with_retries(new_message, messages: list = []):
     """
     Sends a message to Claude and retries if a RateLimitError occurs.
@@ -83,18 +139,19 @@ def ask_claude_with_retries(new_message, messages: list = []):
 
     Returns:
         The response from ask_claude.
+
+    Raises:
+        RateLimitError: If the request is still rate limited after MAX_ATTEMPTS attempts.
     """
-    sleep_time = 10
-    while True:
+    for attempt in range(MAX_ATTEMPTS):
         try:
-            raise RateLimitError(
-                "Rate Limit Error",
-            )
             return ask_claude(new_message, messages)
         except RateLimitError:
-            print(f"Rate Limit Error. Sleeping {sleep_time}s")
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            sleep_time = backoff(attempt)
+            print(f"Rate Limit Error. Sleeping {sleep_time:.2f}s")
             time.sleep(sleep_time)
-            continue
 
 
 def ask_claude(new_message, messages: list = []):
@@ -112,42 +169,50 @@ def ask_claude(new_message, messages: list = []):
     response = client.beta.tools.messages.create(
         model=CLAUDE_MODEL,
         max_tokens=4096,
-        system=SYSTEM_PROMPT,
-        tools=[
-            {
-                "name": "get_weather",
-                "description": "Get the current weather in a given location",
-                "input_schema": {
-                    "type": "object",
-                    "properties": {
-                        "location": {
-                            "type": "string",
-                            "description": "The city and state, e.g. San Francisco, CA",
-                        }
-                    },
-                    "required": ["location"],
-                },
-            },
+        system=[
             {
-                "name": "get_facts",
-                "description": "Use this tool to get facts about any topic. Assume that this tool is returning definitive answers from a reliable source. You can only look up one topic at a time. For example, if someone asks 'How many people live in Providence, RI?' You would input 'Providence, RI' as the topic.",
-                "input_schema": {
-                    "type": "object",
-                    "properties": {
-                        "topic": {
-                            "type": "string",
-                            "description": "The topic for retrieving facts",
-                        }
-                    },
-                    "required": ["location"],
-                },
-            },
+                "type": "text",
+                "text": SYSTEM_PROMPT,
+                "cache_control": {"type": "ephemeral"},
+            }
         ],
+        tools=TOOLS,
         messages=new_messages,
+        extra_headers=BETA_HEADERS,
     )
     return response, new_messages
 
 
+def estimate_tokens(messages):
+    """
+    Roughly estimates the number of tokens in a conversation, at ~4 characters per token.
+
+    Args:
+        messages (list): List of messages in the conversation.
+
+    Returns:
+        int: The approximate number of tokens.
+    """
+    return len(json.dumps(messages, default=lambda block: block.model_dump())) // 4
+
+
+def trim_messages(messages, max_tokens=MAX_CONTEXT_TOKENS):
+    """
+    Drops the oldest tool calls from the conversation until it fits within max_tokens.
+    The first user message and the latest assistant message are always kept, and each assistant tool use
+    is dropped together with the tool result that follows it, so every remaining tool_result has its tool_use.
+
+    Args:
+        messages (list): List of messages in the conversation, ending in an assistant message. Trimmed in place.
+        max_tokens (int, optional): The approximate token budget for the conversation. Defaults to MAX_CONTEXT_TOKENS.
+
+    Returns:
+        None
+    """
+    while len(messages) > 2 and estimate_tokens(messages) > max_tokens:
+        del messages[1:3]
+
+
 def main():
     """
     This function represents the main entry point of the program.
@@ -167,15 +232,16 @@ def main():
         new_message = {"role": "user", "content": user_content}
         response, messages = ask_claude_with_retries(new_message, messages)
         messages.append({"role": "assistant", "content": response.content})
+        trim_messages(messages)
         if response.stop_reason == "tool_use":
-            if len(response.content) > 1:
-                thoughts = next(
-                    block for block in response.content if block.type == "text"
-                ).text
-                print("---> Thinking\n", textwrap.indent(thoughts, "      "))
-            tool_use = next(
-                block for block in response.content if block.type == "tool_use"
-            )
+            thoughts_block = tool_use = None
+            for block in response.content:
+                if block.type == "text":
+                    thoughts_block = block
+                elif block.type == "tool_use":
+                    tool_use = block
+            if thoughts_block is not None:
+                print("---> Thinking\n", textwrap.indent(thoughts_block.text, "      "))
             tool_response = handle_tool_use(tool_use.name, tool_use.input)
             user_content = [
                 {
@@ -1,17 +1,52 @@
+import argparse
+import asyncio
 import functools
+import hashlib
+import html
+import inspect
+import itertools
+import json
 import logging
+import pathlib
+import random
 import re
-from anthropic.types.beta.tools.tools_beta_message import ToolsBetaMessage
+from urllib.parse import parse_qs, urlparse
+from anthropic.types import Message
 import yt_dlp
 
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 import sys
-from dotenv import dotenv_values
+import tempfile
+import threading
+from dotenv import load_dotenv
+import os
 import time
-from anthropic import Anthropic, RateLimitError, InternalServerError
+from anthropic import Anthropic, APIError, RateLimitError, InternalServerError
 
 MAX_TOKENS = 4096
-CONFIG = dotenv_values(".env")
+load_dotenv()
+BETA_HEADERS = {"anthropic-beta": "prompt-caching-2024-07-31"}
+CACHE_DIR = pathlib.Path.home() / ".cache" / "yt_summarizer"
+SUMMARY_CACHE_FILE = CACHE_DIR / "summary_cache.json"
+# Roughly 100k tokens, leaving plenty of the context window for the summary
+MAX_CAPTIONS_CHARS = 400_000
+CUE_TIMING_PATTERN = re.compile(r"^(?:\d+:)?\d+:\d+\.\d+ -->")
+INLINE_TAG_PATTERN = re.compile(r"<[^>]+>")
+MIN_OVERLAP_WORDS = 3
+# YouTube video IDs are 11 URL-safe base64 characters; anything else can't be used as a cache file name
+VIDEO_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{11}$")
+# yt-dlp's subtitle listings, in order of preference
+SUBTITLES_SOURCES = ("subtitles", "automatic_captions")
+VIDEO_HEADER_PATTERN = re.compile(r"^#+\s*Video (\d+)\b.*$", re.MULTILINE)
+# Rough size of one video's scratchpad and summary, used to keep batched responses within MAX_TOKENS
+SUMMARY_BASE_TOKENS = 500
+SUMMARY_CHARS_PER_TOKEN = 8
+# Captions too long for one request are summarized in parts small enough for each part's summary to fit
+MAX_PART_CHARS = (MAX_TOKENS - SUMMARY_BASE_TOKENS) * SUMMARY_CHARS_PER_TOKEN
+# Parts smaller than this aren't split any further if their summary is still cut off
+MIN_PART_CHARS = 10_000
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -23,7 +58,12 @@ MODEL_NAMES = {
     "opus": "claude-3-opus-20240229",
 }
 
-CLAUDE_MODEL = MODEL_NAMES["sonnet"]
+# --quality overrides the length-based model choice in choose_model
+QUALITY_MODELS = {
+    "fast": MODEL_NAMES["haiku"],
+    "balanced": MODEL_NAMES["sonnet"],
+    "best": MODEL_NAMES["opus"],
+}
 
 SYSTEM_PROMPT = """
 User: You are a research assistant who summarizes videos for professors looking to create educational content. Your goal is to provide an exhaustive summary of the video content, highlighting key points and concepts.
@@ -51,17 +91,50 @@ Here are some rules for the interaction:
 """
 
 
+# Shared across all calls so its connection pool is reused - don't instantiate a new client per request
 client = Anthropic(
-    api_key=CONFIG["claude_key"],
+    api_key=os.getenv("claude_key", os.getenv("ANTHROPIC_API_KEY")),
+)
+
+RETRYABLE_ERRORS = (
+    RateLimitError,
+    InternalServerError,
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.HTTPError,
 )
 
 
-def with_retries(max_wait_time=float("inf")):
+def is_retryable(e):
+    """
+    Checks whether an error from RETRYABLE_ERRORS should be retried.
+    HTTP errors are only retried for 429 and 5XX responses - anything else (e.g. a 404) won't fix itself.
+
+    Args:
+        e (Exception): The error raised by the decorated function.
+
+    Returns:
+        bool: True if the call should be retried.
+    """
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and (
+            e.response.status_code == 429 or e.response.status_code >= 500
+        )
+    return True
+
+
+# Shared session so caption downloads reuse pooled connections instead of doing a new TLS handshake each time
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=10))
+
+
+def with_retries(max_wait_time=float("inf"), max_attempts=8):
     """
     A decorator that adds retry functionality to a function.
 
     Args:
       max_wait_time (float, optional): The maximum wait time in seconds between retries. Defaults to infinity.
+      max_attempts (int, optional): The maximum number of attempts before the last error is re-raised. Defaults to 8.
 
     Returns:
       function: The decorated function.
@@ -74,170 +147,742 @@ def with_retries(max_wait_time=float("inf")):
 
         Yields the Fibonacci numbers starting from 0 and 1, which can be used as wait times in a loop.
         The Fibonacci sequence is generated until max_wait_time is reached (default: infinity)
+        Each wait time has up to 50% random jitter added, so concurrent callers don't retry in lockstep.
 
         Returns:
-          int: The next Fibonacci number in the sequence.
+          float: The next Fibonacci number in the sequence, with jitter applied.
 
         """
         a, b = (0, 1)
         while True:
-            yield a
+            yield a * (1 + random.uniform(0, 0.5))
             if b <= max_wait_time:
                 (a, b) = (b, a + b)
 
+    def get_sleep_time(e, sleep_time_generator):
+        """
+        Logs a retryable error and works out how long to wait before retrying.
+        Not intended for direct use - use the top level function, with_retries.
+
+        Args:
+          e (Exception): The error raised by the decorated function.
+          sleep_time_generator (generator): The wait time generator for the current call.
+
+        Returns:
+          float: The number of seconds to sleep before retrying.
+
+        """
+        logger.debug(e)
+        if isinstance(e, RateLimitError):
+            sleep_time = next(sleep_time_generator)
+            logger.error(
+                f"{e.status_code} Rate Limit Error: {e.message} \nSleeping {sleep_time:.2f}s before retrying"
+            )
+        elif isinstance(e, InternalServerError):
+            sleep_time = (
+                next(sleep_time_generator) + 30
+            )  # Let's chill a bit longer for 5XX errors
+            logger.error(
+                f"{e.status_code} Internal Server Error: {e.message} \nSleeping {sleep_time:.2f}s before retrying"
+            )
+        elif isinstance(e, requests.HTTPError):
+            sleep_time = next(sleep_time_generator)
+            if e.response.status_code >= 500:
+                sleep_time += 30  # Same extra wait as Anthropic's 5XX errors
+            logger.error(
+                f"HTTP Error: {e} \nSleeping {sleep_time:.2f}s before retrying"
+            )
+        else:
+            sleep_time = next(sleep_time_generator)
+            logger.error(
+                f"Connection Error: {e} \nSleeping {sleep_time:.2f}s before retrying"
+            )
+        return sleep_time
+
     def decorator_with_retries(func):
         """
-        A function wrapper that handles rate limit and internal server errors with retry functionality.
+        A function wrapper that handles rate limit, internal server, HTTP and connection errors with retry functionality.
+        Coroutine functions get a wrapper that sleeps with asyncio.sleep, so retries don't block the event loop.
         Not intended for direct use - use the top level function, with_retries.
         """
 
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             """
-            A function wrapper that handles rate limit and internal server errors with retry functionality.
+            A function wrapper that handles rate limit, internal server, HTTP and connection errors with retry functionality.
             Not intended for direct use - use the top level function, with_retries.
             """
             sleep_time_generator = fibonacci_wait_times()
+            attempts = 0
             while True:
                 try:
-                    return func(*args, *kwargs)
-                except RateLimitError as e:
-                    sleep_time = next(sleep_time_generator)
-                    logger.debug(e)
-                    logger.error(
-                        f"{e.status_code} Rate Limit Error: {e.message} \nSleeping {sleep_time}s before retrying"
-                    )
-                    time.sleep(sleep_time)
-                    continue
-                except InternalServerError as e:
-                    sleep_time = (
-                        next(sleep_time_generator) + 30
-                    )  # Let's chill a bit longer for 5XX errors
-                    logger.debug(e)
-                    logger.error(
-                        f"{e.status_code} Internal Server Error: {e.message} \nSleeping {sleep_time}s before retrying"
-                    )
-                    time.sleep(sleep_time)
-                    continue
+                    return func(*args, **kwargs)
+                except RETRYABLE_ERRORS as e:
+                    attempts += 1
+                    if attempts >= max_attempts or not is_retryable(e):
+                        raise
+                    time.sleep(get_sleep_time(e, sleep_time_generator))
 
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            """
+            The coroutine equivalent of wrapper, sleeping between retries without blocking the event loop.
+            Not intended for direct use - use the top level function, with_retries.
+            """
+            sleep_time_generator = fibonacci_wait_times()
+            attempts = 0
+            while True:
+                try:
+                    return await func(*args, **kwargs)
+                except RETRYABLE_ERRORS as e:
+                    attempts += 1
+                    if attempts >= max_attempts or not is_retryable(e):
+                        raise
+                    await asyncio.sleep(get_sleep_time(e, sleep_time_generator))
+
+        if inspect.iscoroutinefunction(func):
+            return async_wrapper
         return wrapper
 
     return decorator_with_retries
 
 
 @with_retries(max_wait_time=60)
-def ask_claude(new_message, messages: list = []):
+def ask_claude(new_message, model, messages: list = [], stream_output=True):
     """
-    Sends a new message to Claude and returns the response.
+    Sends a new message to Claude, streaming the response text to stdout as it arrives.
 
     Args:
         new_message (str): The new message to send to Claude.
+        model (str): The Claude model to use, one of MODEL_NAMES.
         messages (list, optional): List of previous messages. Defaults to an empty list.
+        stream_output (bool, optional): Whether to write the response text to stdout. Defaults to True.
 
     Returns:
-        tuple: A tuple containing the response from Claude and the updated list of messages.
+        tuple: A tuple containing the final response from Claude and the updated list of messages.
     """
     logger.info("Requesting summary from Claude")
     new_messages = messages + [new_message]
-    response: ToolsBetaMessage = client.beta.tools.messages.create(
-        model=CLAUDE_MODEL,
+    with client.messages.stream(
+        model=model,
         max_tokens=MAX_TOKENS,
-        system=SYSTEM_PROMPT,
+        system=[
+            {
+                "type": "text",
+                "text": SYSTEM_PROMPT,
+                "cache_control": {"type": "ephemeral"},
+            }
+        ],
         messages=new_messages,
-    )
+        extra_headers=BETA_HEADERS,
+    ) as stream:
+        if stream_output:
+            for text in stream.text_stream:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            sys.stdout.write("\n")
+        response: Message = stream.get_final_message()
     return response, new_messages
 
 
-def clean_captions(subtitles):
+def split_captions(captions, max_chars=MAX_CAPTIONS_CHARS):
     """
-    Cleans the given subtitles by removing unwanted patterns and duplicates.
+    Splits captions into chunks small enough to summarize in a single request, breaking on line boundaries.
 
     Args:
-        subtitles (str): The subtitles to be cleaned.
+        captions (str): The cleaned captions.
+        max_chars (int, optional): The maximum length of each chunk. Defaults to MAX_CAPTIONS_CHARS.
 
     Returns:
-        str: The cleaned subtitles.
+        list: The caption chunks, in order. Short captions are returned as a single chunk.
+    """
+    chunks = []
+    current_lines = []
+    current_length = 0
+    for line in captions.split("\n"):
+        if current_lines and current_length + len(line) + 1 > max_chars:
+            chunks.append("\n".join(current_lines))
+            current_lines = []
+            current_length = 0
+        current_lines.append(line)
+        current_length += len(line) + 1
+    if current_lines:
+        chunks.append("\n".join(current_lines))
+    return chunks
+
+
+def warm_up_client():
+    """
+    Opens a connection to the Anthropic API ahead of the first real request, so the TCP/TLS handshake
+    isn't paid for on the critical path. Failures are logged and otherwise ignored.
+    """
+    try:
+        client.get("/v1/models", cast_to=httpx.Response)
+    except APIError as e:
+        logger.debug(f"Anthropic client warm-up failed: {e}")
 
+
+def clean_vtt(text: str, automatic_captions: bool = False) -> str:
     """
-    cleaned_subtitles = subtitles
-    replacements = [
-        (r".*\d+:\d+:\d+\.\d+.*", ""),
-        ((r"\n+", "\n")),
-    ]
-    for old, new in replacements:
-        cleaned_subtitles = re.sub(old, new, cleaned_subtitles)
+    Cleans a WebVTT subtitles file down to its spoken text.
+    Cue timings and identifiers, headers, notes and inline tags are dropped. For automatic captions, the text
+    repeated from the previous cue (their rolling window) is also removed, so each word of the transcript appears
+    once. Uploaded subtitles don't repeat text between cues, so only a line identical to the one before it is
+    dropped.
 
-    cleaned_subtitles_array = cleaned_subtitles.split("\n")
-    cleaned_subtitles_array = [i for i in cleaned_subtitles_array if i != " "]
-    deduped_subtitles_array = []
-    for index, line in enumerate(cleaned_subtitles_array):
-        if (
-            index > 0
-            and cleaned_subtitles_array[index] != cleaned_subtitles_array[index - 1]
-        ):
-            deduped_subtitles_array.append(line)
+    Args:
+        text (str): The WebVTT subtitles to be cleaned.
+        automatic_captions (bool, optional): Whether the subtitles are YouTube's automatic captions. Defaults to
+            False.
+
+    Returns:
+        str: The cleaned subtitles, with the new text from each cue on its own line.
+
+    """
+    transcript_words = []
+    cleaned_lines = []
+    for block in re.split(r"\n{2,}", text.replace("\r\n", "\n")):
+        block_lines = block.split("\n")
+        timing_index = next(
+            (
+                index
+                for index, line in enumerate(block_lines)
+                if CUE_TIMING_PATTERN.match(line)
+            ),
+            None,
+        )
+        # Blocks without a timing line are the header, NOTE, STYLE or REGION blocks, not cues
+        if timing_index is None:
+            continue
+
+        # Anything before the timing line is the cue identifier
+        lines = [
+            html.unescape(INLINE_TAG_PATTERN.sub("", line)).strip()
+            for line in block_lines[timing_index + 1 :]
+        ]
+        lines = [line for line in lines if line]
+        if not lines:
+            continue
+
+        if not automatic_captions:
+            for line in lines:
+                if not cleaned_lines or line != cleaned_lines[-1]:
+                    cleaned_lines.append(line)
+            continue
+
+        cue_words = " ".join(lines).split()
+        line_ends = set(itertools.accumulate(len(line.split()) for line in lines))
+        overlap = min(len(cue_words), len(transcript_words))
+        while overlap and transcript_words[-overlap:] != cue_words[:overlap]:
+            overlap -= 1
+        # Short overlaps are usually a word that really was said again, unless whole lines are repeated
+        if overlap < MIN_OVERLAP_WORDS and overlap not in line_ends:
+            overlap = 0
+        new_words = cue_words[overlap:]
+        if new_words:
+            transcript_words.extend(new_words)
+            cleaned_lines.append(" ".join(new_words))
+
+    return "\n".join(cleaned_lines)
+
+
+def get_video_id(video_url):
+    """
+    Extracts the video ID from a YouTube URL.
+
+    Args:
+        video_url (str): The URL of the YouTube video, e.g. https://www.youtube.com/watch?v=kJvXT25LkwA
+
+    Returns:
+        str: The video ID.
+
+    Raises:
+        ValueError: If the URL doesn't contain a valid video ID.
+    """
+    video_id = parse_qs(urlparse(video_url).query).get("v", [""])[0]
+    if not VIDEO_ID_PATTERN.fullmatch(video_id):
+        raise ValueError(f"Invalid YouTube video ID {video_id!r} in {video_url}")
+    return video_id
+
+
+def get_summary_cache_key(captions, question, model):
+    """
+    Builds the summary cache key for a set of captions and a question.
+    The model and system prompt are part of the key, so changing either invalidates old entries.
+
+    Args:
+        captions (str): The cleaned captions sent to Claude.
+        question (str): The question asked about the captions.
+        model (str): The Claude model used for the summary.
+
+    Returns:
+        str: A SHA-256 hex digest identifying the request.
+    """
+    return hashlib.sha256(
+        json.dumps([model, SYSTEM_PROMPT, captions, question]).encode()
+    ).hexdigest()
 
-    return "\n".join(deduped_subtitles_array)
 
+def load_summary_cache():
+    """
+    Loads the summary cache from disk.
+
+    Returns:
+        dict: The cached summaries keyed by get_summary_cache_key, or an empty dict if there is no cache yet.
+    """
+    if not SUMMARY_CACHE_FILE.exists():
+        return {}
+    try:
+        return json.loads(SUMMARY_CACHE_FILE.read_text())
+    except json.JSONDecodeError as e:
+        logger.warning(f"Ignoring corrupt summary cache {SUMMARY_CACHE_FILE}: {e}")
+        return {}
+
+
+def save_summary(cache_key, summary):
+    """
+    Adds a summary to the on-disk summary cache.
+
+    Args:
+        cache_key (str): The key from get_summary_cache_key.
+        summary (str): The summary text returned by Claude.
+    """
+    summary_cache = load_summary_cache()
+    summary_cache[cache_key] = summary
+    write_atomically(SUMMARY_CACHE_FILE, [json.dumps(summary_cache).encode()])
+
+
+def write_atomically(path, chunks):
+    """
+    Writes data to a file via a temporary file in the same directory, so an interrupted write never leaves a
+    partial file behind for later runs to read.
+
+    Args:
+        path (pathlib.Path): The file to write.
+        chunks (iterable): The bytes to write, in order.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "wb", dir=path.parent, suffix=".tmp", delete=False
+    ) as temporary_file:
+        try:
+            for chunk in chunks:
+                temporary_file.write(chunk)
+        except BaseException:
+            temporary_file.close()
+            os.unlink(temporary_file.name)
+            raise
+    os.replace(temporary_file.name, path)
+
+
+def get_subtitles_url(video_info, language="en"):
+    """
+    Picks the WebVTT subtitles URL for a language out of yt-dlp's video info.
+    Uploaded subtitles are preferred over automatic captions.
+
+    Args:
+        video_info (dict): The unprocessed info dict from yt-dlp's extract_info.
+        language (str, optional): The subtitles language. Defaults to "en".
 
+    Returns:
+        tuple: The subtitles URL and its source ("subtitles" or "automatic_captions"), or (None, None) if there
+        are no subtitles in that language.
+    """
+    for source in SUBTITLES_SOURCES:
+        for subtitles in (video_info.get(source) or {}).get(language, []):
+            if subtitles.get("ext") == "vtt":
+                return subtitles["url"], source
+    return None, None
+
+
+@functools.lru_cache(maxsize=128)
+@with_retries(max_wait_time=60)
 def download_captions(video_url):
     """
-    Downloads the captions for a YouTube video.
+    Downloads and cleans the captions for a YouTube video.
+    The raw subtitles file is streamed to disk and cached by video ID and source, so repeat runs for the same
+    video skip the download. Cleaning always runs on the raw file, so changes to clean_vtt also apply to cached videos.
 
     Args:
         video_url (str): The URL of the YouTube video.
 
     Returns:
-        str: The downloaded captions as a string, or None if no English captions are available.
+        str: The cleaned captions as a string, or None if no English captions are available.
     """
-    ydl = yt_dlp.YoutubeDL(
-        {
-            "writesubtitles": True,
-            "subtitleslangs": ["en"],
-            "writeautomaticsub": True,
-            "logtostderr": True,
-            "quiet": True,
-            "logger": logger,
-        }
-    )
-    logger.info(f"Downloading captions for {video_url}")
-    res = ydl.extract_info(video_url, download=False)
-    if res["requested_subtitles"] and res["requested_subtitles"]["en"]:
-        logger.debug(f'Subtitles URL: {res["requested_subtitles"]["en"]["url"]}')
-        response = requests.get(res["requested_subtitles"]["en"]["url"], stream=True)
-
-        return response.text
+    video_id = get_video_id(video_url)
+    for source in SUBTITLES_SOURCES:
+        captions_file = CACHE_DIR / f"{video_id}.{source}.vtt"
+        if captions_file.exists():
+            logger.info(f"Using cached captions for {video_url}")
+            break
     else:
-        logger.error("This YouTube video does not have any English captions")
+        ydl = yt_dlp.YoutubeDL(
+            {
+                "skip_download": True,
+                "youtube_include_dash_manifest": False,
+                "youtube_include_hls_manifest": False,
+                "extractor_args": {"youtube": {"player_skip": ["webpage", "configs"]}},
+                "logtostderr": True,
+                "quiet": True,
+                "logger": logger,
+            }
+        )
+        logger.info(f"Downloading captions for {video_url}")
+        # process=False skips format resolution - only the subtitle listings are needed
+        res = ydl.extract_info(video_url, download=False, process=False)
+        subtitles_url, source = get_subtitles_url(res)
+        if not subtitles_url:
+            logger.error("This YouTube video does not have any English captions")
+            return None
+        captions_file = CACHE_DIR / f"{video_id}.{source}.vtt"
+        logger.debug(f"Subtitles URL: {subtitles_url}")
+        with SESSION.get(subtitles_url, stream=True, timeout=(5, 30)) as response:
+            response.raise_for_status()
+            write_atomically(captions_file, response.iter_content(chunk_size=65536))
+
+    captions = clean_vtt(
+        captions_file.read_text(encoding="utf-8"),
+        automatic_captions=source == "automatic_captions",
+    )
+    if not captions:
+        logger.error(f"The captions for {video_url} don't contain any text")
+        captions_file.unlink()
         return None
+    return captions
 
 
-def main(video_url):
-    captions = download_captions(video_url=video_url)
-    if not captions:
-        return
-    new_message = {
+def build_captions_message(captions, question):
+    """
+    Builds the user message asking Claude a question about a set of captions.
+
+    Args:
+        captions (str): The cleaned captions.
+        question (str): The question to ask about the captions.
+
+    Returns:
+        dict: The user message.
+    """
+    return {
         "role": "user",
         "content": [
-            {"type": "text", "text": clean_captions(captions)},
-            {"type": "text", "text": "Can you summarize the video?"},
+            {
+                "type": "text",
+                "text": captions,
+                "cache_control": {"type": "ephemeral"},
+            },
+            {"type": "text", "text": question},
         ],
     }
-    response, _ = ask_claude(new_message)
 
-    print(response.content[0].text)
 
+def summarize_captions(captions, question, model):
+    """
+    Asks Claude to summarize the given captions, streaming the summary to stdout.
+    Captions too long for a single request are summarized in parts, and the partial summaries are then merged.
+    A part whose summary is cut off by the token limit is split in two and summarized again.
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        logger.error(
-            "Error: Please provide a valid YouTube URL as a command line argument."
+    Args:
+        captions (str): The cleaned captions.
+        question (str): The question to ask about the captions.
+        model (str): The Claude model to use.
+
+    Returns:
+        tuple: The summary text and a stop_reason - "end_turn" if the summary is complete, otherwise the first
+        stop_reason that wasn't.
+    """
+    if len(captions) <= MAX_CAPTIONS_CHARS:
+        response, _ = ask_claude(build_captions_message(captions, question), model)
+        return response.content[0].text, response.stop_reason
+
+    parts = split_captions(captions, max_chars=MAX_PART_CHARS)
+    logger.info(
+        f"Captions are too long for one request, summarizing in {len(parts)} parts"
+    )
+    partial_summaries = []
+    stop_reasons = []
+    while parts:
+        part = parts.pop(0)
+        response, _ = ask_claude(
+            build_captions_message(
+                part,
+                f"This is part {len(partial_summaries) + 1} of the video, the other parts are summarized separately. {question}",
+            ),
+            model,
+            stream_output=False,
         )
-        sys.exit(1)
+        if response.stop_reason == "max_tokens" and len(part) > MIN_PART_CHARS:
+            halves = split_captions(part, max_chars=len(part) // 2 + 1)
+            if len(halves) > 1:
+                logger.info(
+                    f"The summary of part {len(partial_summaries) + 1} was cut off, splitting it into {len(halves)} parts"
+                )
+                parts[:0] = halves
+                continue
+        partial_summaries.append(response.content[0].text)
+        stop_reasons.append(response.stop_reason)
+
+    merge_message = {
+        "role": "user",
+        "content": [
+            {"type": "text", "text": partial_summary}
+            for partial_summary in partial_summaries
+        ]
+        + [
+            {
+                "type": "text",
+                "text": "These are summaries of consecutive parts of the same video. Can you merge them into a single summary of the whole video?",
+            }
+        ],
+    }
+    response, _ = ask_claude(merge_message, model)
+    stop_reasons.append(response.stop_reason)
+    stop_reason = next(
+        (reason for reason in stop_reasons if reason != "end_turn"), "end_turn"
+    )
+    return response.content[0].text, stop_reason
+
 
-    video_url: str = sys.argv[1]
-    if not video_url.startswith("https://www.youtube.com/watch?v="):
-        logger.error("Error: Invalid YouTube URL format.")
-        sys.exit(1)
+def parse_video_summaries(text):
+    """
+    Splits a batched response into per-video summaries, using the "# Video <number>" headers Claude was asked to write.
+    Headers at any level, or with a title after the number (e.g. "## Video 2: Cats"), are accepted.
+
+    Args:
+        text (str): The response text from Claude.
+
+    Returns:
+        dict: The summaries keyed by video number, in the order they appear. Videos without a header are missing
+        from the result.
+    """
+    sections = VIDEO_HEADER_PATTERN.split(text)
+    return {
+        int(number): summary.strip()
+        for number, summary in zip(sections[1::2], sections[2::2])
+    }
 
-    main(video_url=video_url)
+
+def estimate_summary_tokens(captions):
+    """
+    Roughly estimates how many output tokens Claude needs to summarize a video.
+
+    Args:
+        captions (str): The cleaned captions.
+
+    Returns:
+        int: The approximate number of tokens in the scratchpad and summary.
+    """
+    return SUMMARY_BASE_TOKENS + len(captions) // SUMMARY_CHARS_PER_TOKEN
+
+
+def plan_batches(videos):
+    """
+    Groups videos into batches whose combined captions fit in one request, and whose combined summaries are
+    expected to fit in MAX_TOKENS.
+
+    Args:
+        videos (list): (video number, cleaned captions) tuples, in order.
+
+    Returns:
+        list: Lists of (video number, cleaned captions) tuples, one per batch. Videos too big to share a request
+        end up in a batch of their own.
+    """
+    batches = []
+    current_batch = []
+    batch_chars = 0
+    batch_tokens = 0
+    for number, captions in videos:
+        summary_tokens = estimate_summary_tokens(captions)
+        if current_batch and (
+            batch_chars + len(captions) > MAX_CAPTIONS_CHARS
+            or batch_tokens + summary_tokens > MAX_TOKENS
+        ):
+            batches.append(current_batch)
+            current_batch = []
+            batch_chars = 0
+            batch_tokens = 0
+        current_batch.append((number, captions))
+        batch_chars += len(captions)
+        batch_tokens += summary_tokens
+    if current_batch:
+        batches.append(current_batch)
+    return batches
+
+
+def summarize_videos(videos, question, model):
+    """
+    Asks Claude to summarize several videos, batching as many into each request as fit, and printing the
+    summaries to stdout in video number order.
+    Batched responses aren't streamed, so that only complete summaries are printed. Videos missing from a batched
+    response, or cut off by the token limit, are summarized again on their own and streamed.
+
+    Args:
+        videos (list): (video number, cleaned captions) tuples for the videos to summarize.
+        question (str): The question to ask about each video.
+        model (str): The Claude model to use.
+
+    Returns:
+        dict: (summary text, stop_reason) tuples keyed by video number.
+    """
+    summaries = {}
+    for batch in plan_batches(videos):
+        if len(batch) == 1:
+            number, captions = batch[0]
+            print(f"# Video {number}")
+            summaries[number] = summarize_captions(captions, question, model)
+            continue
+
+        content = [
+            {"type": "text", "text": f"Video {number}: {captions}"}
+            for number, captions in batch
+        ]
+        content[-1]["cache_control"] = {"type": "ephemeral"}
+        content.append(
+            {
+                "type": "text",
+                "text": f"{question} Summarize each video separately, starting each video's summary with a '# Video <number>' header on its own line.",
+            }
+        )
+        response, _ = ask_claude(
+            {"role": "user", "content": content}, model, stream_output=False
+        )
+        batch_summaries = parse_video_summaries(response.content[0].text)
+        # Only the last section can be cut off, and only if the response hit the token limit
+        last_number = list(batch_summaries)[-1] if batch_summaries else None
+
+        for number, captions in batch:
+            if number in batch_summaries and (
+                response.stop_reason == "end_turn" or number != last_number
+            ):
+                summaries[number] = (batch_summaries[number], "end_turn")
+                print(f"# Video {number}")
+                print(batch_summaries[number])
+                continue
+            logger.warning(
+                f"The summary for video {number} is missing or incomplete ({response.stop_reason}), summarizing it on its own"
+            )
+            print(f"# Video {number}")
+            summaries[number] = summarize_captions(captions, question, model)
+    return summaries
+
+
+def choose_model(captions, quality=None):
+    """
+    Picks a Claude model for summarizing the given captions.
+    Short videos go to the fastest model, and longer ones to progressively more capable models.
+
+    Args:
+        captions (str): The cleaned captions.
+        quality (str, optional): One of QUALITY_MODELS, overriding the length-based choice. Defaults to None.
+
+    Returns:
+        str: The Claude model to use.
+    """
+    if quality:
+        return QUALITY_MODELS[quality]
+    if len(captions) < 10_000:
+        return MODEL_NAMES["haiku"]
+    if len(captions) < 40_000:
+        return MODEL_NAMES["sonnet"]
+    return MODEL_NAMES["opus"]
+
+
+async def main(video_urls, quality=None):
+    # One unavailable video shouldn't throw away the captions that did download
+    all_captions = await asyncio.gather(
+        *(
+            asyncio.to_thread(download_captions, video_url=video_url)
+            for video_url in video_urls
+        ),
+        return_exceptions=True,
+    )
+    question = "Can you summarize the video?"
+    show_headers = len(video_urls) > 1
+
+    summary_cache = load_summary_cache()
+    videos = []
+    for number, (video_url, captions) in enumerate(
+        zip(video_urls, all_captions), start=1
+    ):
+        if isinstance(captions, Exception):
+            logger.error(f"Could not download captions for {video_url}: {captions}")
+            continue
+        if not captions:
+            continue
+        model = choose_model(captions, quality)
+        cache_key = get_summary_cache_key(captions, question, model)
+        videos.append((number, video_url, captions, model, cache_key))
+
+    # Summaries are printed in video number order, so only consecutive uncached videos for the same model are
+    # batched together, and each summary is cached under the model that wrote it
+    for (cached, model), group in itertools.groupby(
+        videos, key=lambda video: (video[4] in summary_cache, video[3])
+    ):
+        group = list(group)
+        if cached:
+            for number, video_url, _, _, cache_key in group:
+                logger.info(f"Using cached summary for {video_url}")
+                if show_headers:
+                    print(f"# Video {number}")
+                print(summary_cache[cache_key])
+            continue
+
+        for _, video_url, _, _, _ in group:
+            logger.info(f"Summarizing {video_url} with {model}")
+        if len(group) == 1:
+            number, _, captions, _, _ = group[0]
+            if show_headers:
+                print(f"# Video {number}")
+            summaries = {
+                number: await asyncio.to_thread(
+                    summarize_captions, captions, question, model
+                )
+            }
+        else:
+            summaries = await asyncio.to_thread(
+                summarize_videos,
+                [(number, captions) for number, _, captions, _, _ in group],
+                question,
+                model,
+            )
+
+        for number, _, _, _, cache_key in group:
+            if number not in summaries:
+                logger.error(
+                    f"Could not find the summary for video {number} in the response"
+                )
+                continue
+            summary, stop_reason = summaries[number]
+            if stop_reason == "end_turn":
+                save_summary(cache_key, summary)
+            else:
+                logger.warning(
+                    f"The summary for video {number} is incomplete ({stop_reason}), not caching it"
+                )
+
+
+if __name__ == "__main__":
+    # Connect in the background while arguments are parsed and captions download
+    threading.Thread(target=warm_up_client, daemon=True).start()
+
+    parser = argparse.ArgumentParser(
+        description="Summarize YouTube videos from their captions using Claude."
+    )
+    parser.add_argument("video_urls", nargs="+", help="One or more YouTube URLs")
+    parser.add_argument(
+        "--quality",
+        choices=QUALITY_MODELS,
+        help="Use a fixed model instead of choosing one based on the caption length",
+    )
+    args = parser.parse_args()
+
+    for video_url in args.video_urls:
+        if not video_url.startswith("https://www.youtube.com/watch?v="):
+            logger.error(f"Error: Invalid YouTube URL format: {video_url}")
+            sys.exit(1)
+        try:
+            get_video_id(video_url)
+        except ValueError as e:
+            logger.error(f"Error: {e}")
+            sys.exit(1)
+
+    asyncio.run(main(video_urls=args.video_urls, quality=args.quality))